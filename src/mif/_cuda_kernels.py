@@ -0,0 +1,57 @@
+import cupy as cp
+import cupyx
+
+from src.mif._kernels import metropolis_step_num
+
+r"""
+cupy counterparts of src.mif._kernels with the same signatures, used by IntentionParticle(device='cuda').
+All arrays stay on the gpu; only counts that decide control flow on the host are synchronized.
+"""
+
+
+def systematic_resample(weight, u0, resampled_indices):
+    particle_num = weight.shape[0]
+    cdf = cp.cumsum(weight, dtype=cp.float64)
+    positions = (u0 + cp.arange(particle_num)) / particle_num
+    # positions left over by round-off of the cdf go to the last particle with nonzero weight
+    last_alive = particle_num - 1 - cp.argmax(weight[::-1] > 0)
+    resampled_indices[:] = cp.minimum(cp.searchsorted(cdf, positions), last_alive)
+    return resampled_indices
+
+
+def metropolis_resample(weight, rand_u, rand_v, resampled_indices):
+    step_num, particle_num = rand_u.shape
+    resampled_indices[:] = cp.arange(particle_num)
+    for b in range(step_num):
+        j = cp.minimum((rand_v[b] * particle_num).astype(resampled_indices.dtype), particle_num - 1)
+        accept = rand_u[b] * weight[resampled_indices] <= weight[j] # u <= w[j]/w[current] without dividing by a zero weight
+        resampled_indices[:] = cp.where(accept, j, resampled_indices)
+    return resampled_indices
+
+
+def average_offset_error(x_pred, x_pred_true, aoe):
+    oe = cp.asarray(x_pred) - cp.asarray(x_pred_true)[cp.newaxis] # offset error (particle_num, num_tpp, 2)
+    aoe[:] = cp.linalg.norm(oe, axis=2).mean(axis=1)
+    return aoe
+
+
+def softmax_update(log_weight, gap, tau, weight):
+    log_weight -= tau * gap
+    log_weight -= log_weight.max()
+    cp.exp(log_weight, out=weight)
+    weight /= weight.sum(dtype=cp.float64) # float64 accumulator, also for float32 weights
+    return weight
+
+
+def mutate_kernel(intention, intention_num, mutation_prob, rands):
+    mutation_mask = rands < mutation_prob
+    # given rands < mutation_prob, rands/mutation_prob is uniform in [0, 1), so the same draw picks the new intention.
+    intention[mutation_mask] = cp.minimum(rands[mutation_mask] / mutation_prob * intention_num, intention_num - 1).astype(intention.dtype)
+    return int(mutation_mask.sum())
+
+
+def intention_prob_dist(weight, intention, intention_num):
+    # cupy has no add.reduceat, so weights are scattered onto their intentions instead.
+    intention_prob = cp.zeros(intention_num)
+    cupyx.scatter_add(intention_prob, intention, weight.astype(cp.float64))
+    return intention_prob # (intention_num,)
@@ -0,0 +1,171 @@
+import numpy as np
+from numba import njit, prange
+
+r"""
+numba kernels for the per-step numeric work of IntentionParticle.
+Each kernel fuses what used to be several numpy passes and temporaries into plain loops.
+"""
+
+PARALLEL_PARTICLE_NUM = 10000 # softmax_update runs multi-threaded from this many particles on.
+
+
+@njit(cache=True, fastmath=True)
+def systematic_resample(weight, u0, resampled_indices):
+    """
+    Walks the cdf and the evenly spaced positions together, in a single pass over weight.
+    inputs:
+        - weight: np. (particle_num,) normalized.
+        - u0: float in [0, 1). the single uniform offset.
+        - resampled_indices: np. (particle_num,) output buffer.
+    outputs:
+        - resampled_indices: np. (particle_num,) nondecreasing.
+    """
+    particle_num = weight.shape[0]
+    weight_cumsum = 0. # float64 accumulator, also for float32 weights
+    j = 0
+    last_alive = particle_num - 1
+    for i in range(particle_num):
+        if weight[i] > 0.:
+            last_alive = i
+        weight_cumsum += weight[i]
+        while j < particle_num and (u0 + j) / particle_num <= weight_cumsum:
+            resampled_indices[j] = i
+            j += 1
+    while j < particle_num: # positions left over by round-off of the cdf go to the last particle with nonzero weight
+        resampled_indices[j] = last_alive
+        j += 1
+    return resampled_indices
+
+
+@njit(cache=True, fastmath=True)
+def average_offset_error(x_pred, x_pred_true, aoe):
+    """
+    inputs:
+        - x_pred: np. (particle_num, num_tpp, 2)
+        - x_pred_true: np. (num_tpp, 2)
+        - aoe: np. (particle_num,) output buffer.
+    outputs:
+        - aoe: np. (particle_num,) mean over time of the euclidean offset error of each particle.
+    """
+    particle_num, num_tpp = x_pred.shape[0], x_pred.shape[1]
+    for i in range(particle_num):
+        oe_sum = 0.
+        for t in range(num_tpp):
+            dx = x_pred[i, t, 0] - x_pred_true[t, 0]
+            dy = x_pred[i, t, 1] - x_pred_true[t, 1]
+            oe_sum += np.sqrt(dx * dx + dy * dy)
+        aoe[i] = oe_sum / num_tpp
+    return aoe
+
+
+METROPOLIS_MAX_STEP_NUM = 100 # cap of metropolis_step_num.
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def metropolis_resample(weight, rand_u, rand_v, resampled_indices):
+    """
+    Metropolis resampling: each particle runs its own chain over step_num weight ratios,
+    no cdf over all particles is needed, so particles are resampled independently in parallel.
+    inputs:
+        - weight: np. (particle_num,)
+        - rand_u: np. (step_num, particle_num) uniform in [0, 1). acceptance draws.
+        - rand_v: np. (step_num, particle_num) uniform in [0, 1). proposal draws, scaled to particle indices.
+        - resampled_indices: np. (particle_num,) output buffer.
+    outputs:
+        - resampled_indices: np. (particle_num,) not ordered.
+    """
+    step_num, particle_num = rand_u.shape
+    for i in prange(particle_num):
+        resampled_indices[i] = i
+        for b in range(step_num):
+            j = min(int(rand_v[b, i] * particle_num), particle_num - 1)
+            if rand_u[b, i] * weight[resampled_indices[i]] <= weight[j]: # u <= w[j]/w[current] without dividing by a zero weight
+                resampled_indices[i] = j
+    return resampled_indices
+
+
+def metropolis_step_num(weight, bias=0.01, max_step_num=METROPOLIS_MAX_STEP_NUM):
+    """
+    Number of metropolis steps B so that the bias of the resampling is below bias,
+    i.e. B >= log(bias)/log(1-beta), with beta = mean(weight)/max(weight) [Murray et al. 2016].
+    """
+    beta = 1. / (weight.shape[0] * float(weight.max()))
+    if beta >= 1.:
+        return 1
+    return int(min(max(np.ceil(np.log(bias) / np.log(1. - beta)), 1), max_step_num))
+
+
+# numba keys its on-disk cache by function name and line, not by the parallel flag,
+# so the serial and parallel builds need separately defined functions.
+@njit(cache=True, fastmath=True)
+def _softmax_update_serial(log_weight, gap, tau, weight):
+    particle_num = log_weight.shape[0]
+    for i in range(particle_num):
+        log_weight[i] -= tau * gap[i]
+    log_weight_max = log_weight[0]
+    for i in range(particle_num):
+        log_weight_max = max(log_weight_max, log_weight[i])
+    weight_sum = 0. # float64 accumulator, also for float32 weights
+    for i in range(particle_num):
+        log_weight[i] -= log_weight_max
+        weight[i] = np.exp(log_weight[i])
+        weight_sum += weight[i]
+    for i in range(particle_num):
+        weight[i] /= weight_sum
+    return weight
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _softmax_update_parallel(log_weight, gap, tau, weight):
+    particle_num = log_weight.shape[0]
+    for i in prange(particle_num):
+        log_weight[i] -= tau * gap[i]
+    log_weight_max = log_weight[0]
+    for i in prange(particle_num):
+        log_weight_max = max(log_weight_max, log_weight[i])
+    weight_sum = 0. # float64 accumulator, also for float32 weights
+    for i in prange(particle_num):
+        log_weight[i] -= log_weight_max
+        weight[i] = np.exp(log_weight[i])
+        weight_sum += weight[i]
+    for i in prange(particle_num):
+        weight[i] /= weight_sum
+    return weight
+
+
+def softmax_update(log_weight, gap, tau, weight):
+    """
+    Adds -tau*gap to log_weight in place, shifts it by its max and writes the normalized weight into weight.
+    inputs:
+        - log_weight: np. (particle_num,)
+        - gap: np. (particle_num,) e.g. average offset error of each particle.
+        - tau: float.
+        - weight: np. (particle_num,) output buffer.
+    outputs:
+        - weight: np. (particle_num,)
+    """
+    if log_weight.shape[0] >= PARALLEL_PARTICLE_NUM:
+        return _softmax_update_parallel(log_weight, gap, tau, weight)
+    return _softmax_update_serial(log_weight, gap, tau, weight)
+
+
+@njit(cache=True, fastmath=True)
+def mutate_kernel(intention, intention_num, mutation_prob, rands):
+    """
+    Redraws intention[i] uniformly over all intentions where rands[i] < mutation_prob, in place.
+    Given rands[i] < mutation_prob, rands[i]/mutation_prob is uniform in [0, 1), so the same draw
+    also picks the new intention.
+    inputs:
+        - intention: np. (particle_num,)
+        - intention_num: int.
+        - mutation_prob: float in [0, 1].
+        - rands: np. (particle_num,) uniform in [0, 1).
+    outputs:
+        - mutation_num: int. the number of redrawn particles.
+    """
+    mutation_num = 0
+    for i in range(intention.shape[0]):
+        if rands[i] < mutation_prob:
+            intention[i] = min(int(rands[i] / mutation_prob * intention_num), intention_num - 1)
+            mutation_num += 1
+    return mutation_num
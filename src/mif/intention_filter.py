@@ -1,4 +1,3 @@
-import numpy as np
 import matplotlib.pyplot as plt
 
 from src.mif.intention_sampler import IntentionSampler
@@ -36,13 +35,9 @@ def IntentionFilter(sample_true, particle_num_per_intent, num_tpp, tau, pred_fun
             i_particle.mutate()
         ## intention prob. dist.
         _, intention_weight_dist = i_particle.particle_weight_intention_prob_dist()
-        particle_intention = i_particle.intention
-        sample_full_pred = i_particle.predict_till_end(sample_true[:last_obs_index+1].numpy(), pred_func)
-        long_pred = []
-        for xy_pred in sample_full_pred:
-            if len(xy_pred) >= num_tpp:
-                long_pred.append(xy_pred[:num_tpp])
-        long_pred = np.stack(long_pred, axis=0) # (sample_size, num_tpp, 2)
+        particle_intention = i_particle.intention.copy() # i_particle updates intention in place
+        i_particle.predict_till_end(sample_true[:last_obs_index+1].numpy(), pred_func)
+        long_pred = i_particle.x_pred_long # (sample_size, num_tpp, 2)
         x_obs, x_gt, x_pred = x_pred_true, x_true_remained[:num_tpp], long_pred
         percentage_hist.append(percentage_curr)
         intention_dist_hist.append(intention_weight_dist)
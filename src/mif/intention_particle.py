@@ -1,7 +1,11 @@
+import re
 import numpy as np
 
+from src.mif import _kernels
+
 class IntentionParticle:
-    def __init__(self, intention_sampler, particle_num_per_intent=200, num_tpp=12):
+    def __init__(self, intention_sampler, particle_num_per_intent=200, num_tpp=12, seed=None, \
+        resample_method='systematic', metropolis_steps=None, device='cpu'):
         """
         input:
             - intention_mean
@@ -11,25 +15,113 @@ class IntentionParticle:
                 the number of particles set for each intention.
             - num_tpp
                 number of trajectory points for prediction.
+            - seed
+                seed of the random generator used for resampling and mutation.
+            - resample_method
+                'systematic' or 'metropolis'.
+            - metropolis_steps
+                number of steps of each metropolis chain. if None, it is chosen from the weights at every resampling.
+            - device
+                'cpu', or 'cuda'/'cuda:0' to keep particle weights and intentions on the gpu with cupy.
+                the prediction function and the intention sampler still run on the host.
+                experimental: the cuda path has not been run on a gpu yet.
         """
+        if not isinstance(device, str) or re.fullmatch(r'cpu|cuda(:\d+)?', device) is None:
+            raise ValueError('Wrong device: '+str(device))
+        device_type, _, device_index = device.partition(':')
+        if device_type == 'cuda':
+            import cupy
+            from src.mif import _cuda_kernels
+            if device_index:
+                cupy.cuda.Device(int(device_index)).use()
+            self.xp, self._kernels = cupy, _cuda_kernels
+        else:
+            self.xp, self._kernels = np, _kernels
         self.intention_sampler = intention_sampler
         self.intention_num = self.intention_sampler.intent_num
         self.intention_coordinates = self.intention_sampler.intent_bottom_left_coordinates + self.intention_sampler.intent_wid
-        self.intention = np.arange(self.intention_num).reshape(-1, 1).dot(\
-            np.ones(particle_num_per_intent).reshape(1,-1)).reshape(-1).astype(int) # [0,0,...,0,1,1,...,1,2,2,...,2] (particle_num,)
+        intention_dtype = np.uint8 if self.intention_num <= 255 else np.uint16
+        self.intention = self.xp.repeat(self.xp.arange(self.intention_num, dtype=intention_dtype), particle_num_per_intent) # [0,0,...,0,1,1,...,1,2,2,...,2] (particle_num,)
         self.num_tpp = num_tpp
-        self.intention_mask = self.create_intention_mask()
+        if resample_method not in ('systematic', 'metropolis'):
+            raise ValueError('Wrong resample method: '+str(resample_method))
+        self.resample_method = resample_method
+        self.metropolis_steps = metropolis_steps
+        self._rng = self.xp.random.default_rng(seed)
         self.particle_num = self.intention_num * particle_num_per_intent
+        # scratch buffers reused across steps
+        # per-particle weights are float32 to halve memory traffic; sums over all particles accumulate in float64.
+        self._u = self.xp.empty(self.particle_num)
+        self._wbuf = self.xp.empty(self.particle_num, dtype=np.float32)
+        self._anc = self.xp.empty(self.particle_num, dtype=np.int32)
+        self.weight = self.xp.empty(self.particle_num, dtype=np.float32)
+        self.log_weight = self.xp.empty(self.particle_num, dtype=np.float32)
+        if resample_method == 'metropolis':
+            # proposal draws of the metropolis chains, one row per step; each resampling fills a prefix of rows.
+            # sized to the largest step_num drawn so far, they grow in resample if metropolis_step_num needs more.
+            step_num = 0 if metropolis_steps is None else metropolis_steps
+            self._rand_u = self.xp.empty((step_num, self.particle_num))
+            self._rand_v = self.xp.empty((step_num, self.particle_num))
         self.reset()
+        self.update_intention_blocks()
     
     def create_intention_mask(self):
-        intention_mask = []
-        for intention_index in range(self.intention_num):
-            intention_mask.append(self.intention == intention_index)
-        return np.vstack(intention_mask) #(intention_num, particle_num)
+        # not used by the filter anymore, kept for inspection.
+        # cached until intentions change, e.g. update_weight alone does not rebuild it.
+        if not self._mask_dirty:
+            return self._intention_mask
+        # particles are sorted by intention, so each row is True on its block only;
+        # fill the blocks instead of comparing all intention_num*particle_num cells.
+        intention_mask = np.zeros((self.intention_num, self.particle_num), dtype=bool)
+        for intention_index, block_slice in enumerate(self.intention_slices):
+            intention_mask[intention_index, block_slice] = True
+        intention_mask.flags.writeable = False # shared by every call until intentions change
+        self._intention_mask = intention_mask
+        self._mask_dirty = False
+        return intention_mask # (intention_num, particle_num)
+
+    def sort_by_intention(self):
+        # keep particles of the same intention contiguous, i.e. [0,0,...,0,1,1,...,1,2,2,...,2],
+        # so that per-intention quantities are segmented sums over the blocks.
+        order = self.xp.argsort(self.intention)
+        self.intention = self.intention[order]
+        self.weight = self.weight[order]
+        self.log_weight = self.log_weight[order]
+        self.update_intention_blocks()
+
+    def update_intention_blocks(self):
+        # blocks are recomputed lazily on first read, so steps that never read them,
+        # e.g. on the gpu where intention_prob_dist scatters instead, do not sync with the host.
+        self._blocks_dirty = True
+        self._mask_dirty = True
+
+    def _compute_intention_blocks(self):
+        if not self._blocks_dirty:
+            return
+        # block starts are kept on the host, they only index slices.
+        self._block_starts = self._to_host(self.xp.searchsorted(self.intention, self.xp.arange(self.intention_num, dtype=self.intention.dtype))) # (intention_num,)
+        self._block_counts = np.diff(np.append(self._block_starts, self.particle_num)) # (intention_num,)
+        self._slices = [slice(block_start, block_start+block_count) for block_start, block_count in zip(self._block_starts, self._block_counts)]
+        self._blocks_dirty = False
+
+    @property
+    def block_starts(self):
+        self._compute_intention_blocks()
+        return self._block_starts
+
+    @property
+    def block_counts(self):
+        self._compute_intention_blocks()
+        return self._block_counts
+
+    @property
+    def intention_slices(self):
+        self._compute_intention_blocks()
+        return self._slices
 
     def reset(self):
-        self.weight = np.ones(self.particle_num) * (1./self.particle_num) # (particle_num,)
+        self.weight.fill(1./self.particle_num) # (particle_num,)
+        self.log_weight.fill(-np.log(self.particle_num)) # (particle_num,)
     
     def resample(self):
         ### soft weight ###
@@ -38,36 +130,68 @@ class IntentionParticle:
         ### original weight ###
         weight_balanced = self.weight
         ######
-        resampled_indices = np.random.choice(self.particle_num, size=self.particle_num, p=weight_balanced)
-        self.intention = self.intention[resampled_indices] # inherited
-        self.intention_mask = self.create_intention_mask()
+        if self.resample_method == 'metropolis':
+            step_num = self.metropolis_steps
+            if step_num is None:
+                step_num = self._kernels.metropolis_step_num(weight_balanced)
+            if self._rand_u.shape[0] < step_num:
+                self._rand_u = self.xp.empty((step_num, self.particle_num))
+                self._rand_v = self.xp.empty((step_num, self.particle_num))
+            rand_u = self._rng.random(out=self._rand_u[:step_num])
+            rand_v = self._rng.random(out=self._rand_v[:step_num])
+            resampled_indices = self._kernels.metropolis_resample(weight_balanced, rand_u, rand_v, self._anc)
+            self.intention = self.intention[resampled_indices] # inherited
+            self.intention.sort() # ancestors are not ordered; weights are uniform after reset, so only intentions need sorting
+        else:
+            # systematic resampling: one uniform offset, particle_num evenly spaced positions on the cdf.
+            resampled_indices = self._kernels.systematic_resample(weight_balanced, self._rng.random(), self._anc) # nondecreasing, so sorted intentions stay sorted
+            self.intention = self.intention[resampled_indices] # inherited
         self.reset()
+        self.update_intention_blocks()
     
     def mutate(self, mutation_prob=0.01):
         # if mutation_prob=0.01, for example, current intention is 1, the chance of the intention being mutated is 0.01.
         # 0.005 percent to intention 2, 0.005 percent to intention 3.
         # In the algorithm, it is 0.985 to keep as it is, 0.005 for each possible intention.
-        mutation_mask_prob = 1.-mutation_prob*self.intention_num/(self.intention_num-1.) # like 0.985 for mutation_prob=0.01
-        mutation_mask = np.random.uniform(size=self.particle_num) > mutation_mask_prob
-        self.intention = self.intention * (1-mutation_mask) \
-            + np.random.randint(0,self.intention_num,self.particle_num) * mutation_mask
-        self.intention = self.intention.astype(int)
-        self.intention_mask = self.create_intention_mask()
+        # A particle is redrawn uniformly over all intentions with prob. mutation_prob*intention_num/(intention_num-1),
+        # like 0.015 for mutation_prob=0.01, which may land on its current intention again.
+        mutation_mask_prob = min(mutation_prob*self.intention_num/(self.intention_num-1.), 1.)
+        mutation_num = self._kernels.mutate_kernel(self.intention, self.intention_num, mutation_mask_prob, self._rng.random(out=self._u))
+        if mutation_num:
+            self.sort_by_intention()
     
     def update_weight(self, x_pred_true, tau=0.1):
-        oe = self.x_pred - x_pred_true[np.newaxis]# offset error (particle_num, num_tpp, 2)
-        aoe = np.mean(np.linalg.norm(oe, axis=2), axis=1) # (particle_num,)
-        self.weight *= np.exp(-tau*aoe)
-        self.weight /= self.weight.sum()
+        aoe = self._kernels.average_offset_error(self.x_pred, x_pred_true, self._wbuf) # (particle_num,)
+        # accumulate in log space and normalize with a max-shifted softmax, so large tau*aoe
+        # does not underflow all weights to zero.
+        self._kernels.softmax_update(self.log_weight, aoe, tau, self.weight)
     
+    def run(self, x_obs_seq, x_pred_true_seq, pred_func, tau=0.1, mutation_on=False, mutation_prob=0.01):
+        """
+        Runs one filtering step per pair of x_obs and x_pred_true in a single call, reusing the scratch buffers.
+        inputs:
+            - x_obs_seq: iterable of np. (t, 2) observed trajectory up to the prediction window.
+            - x_pred_true_seq: iterable of np. (num_tpp, 2) ground truth of the prediction window.
+        outputs:
+            - generator of np. (intention_num,) intention prob. dist. after each step.
+        """
+        for x_obs, x_pred_true in zip(x_obs_seq, x_pred_true_seq):
+            self.predict(x_obs, pred_func)
+            self.update_weight(x_pred_true, tau=tau)
+            self.resample()
+            if mutation_on:
+                self.mutate(mutation_prob=mutation_prob)
+            yield self.intention_prob_dist()
+
     def predict(self, x_obs, pred_func):
         self.goals = self.intention2goal()
-        self.x_pred, _ = pred_func(x_obs, self.goals, self.intention, self.intention_coordinates, intention_num=self.intention_num, num_tpp=self.num_tpp)
+        self.x_pred, _ = pred_func(x_obs, self.goals, self._to_host(self.intention), self.intention_coordinates, intention_num=self.intention_num, num_tpp=self.num_tpp)
         return self.x_pred
     
     def predict_till_end(self, x_obs, long_pred_func):
         self.goals = self.intention2goal()
-        _, infos = long_pred_func(x_obs, self.goals, self.intention, self.intention_coordinates,  intention_num=self.intention_num, num_tpp=self.num_tpp)
+        # x_pred_long holds the first num_tpp steps of every full prediction as one (particle_num, num_tpp, 2) array.
+        self.x_pred_long, infos = long_pred_func(x_obs, self.goals, self._to_host(self.intention), self.intention_coordinates,  intention_num=self.intention_num, num_tpp=self.num_tpp)
         return infos
         
 
@@ -77,12 +201,23 @@ class IntentionParticle:
         # weight_balanced /= sum(weight_balanced)
         ### original weight ###
         weight_balanced = self.weight
-        particle_weight = [] # list of intention_num (3) lists
-        particle_weight_with_zero = self.weight * self.intention_mask# (particle_num,) * (intention_num, particle_num) -> (intention_num, particle_num)
-        for intention_index in range(self.intention_num):
-            particle_weight_intention = particle_weight_with_zero[intention_index, particle_weight_with_zero[intention_index, :].nonzero()]
-            particle_weight.append(np.squeeze(particle_weight_intention, axis=0))
-        return particle_weight, (weight_balanced*self.intention_mask).sum(axis=1)
+        weight_host = self._to_host(self.weight) # host arrays like the prob. dist., also on the gpu
+        # copied, since update_weight and reset overwrite the weight buffer in place.
+        particle_weight = [weight_host[block_slice].copy() for block_slice in self.intention_slices] # list of intention_num (3) arrays
+        return particle_weight, self.intention_prob_dist(weight_balanced)
+
+    def intention_prob_dist(self, weight=None):
+        if weight is None:
+            weight = self.weight
+        if self.xp is not np:
+            return self._to_host(self._kernels.intention_prob_dist(weight, self.intention, self.intention_num))
+        intention_prob = np.zeros(self.intention_num)
+        occupied = self.block_counts > 0 # reduceat needs strictly increasing in-range starts
+        intention_prob[occupied] = np.add.reduceat(weight, self.block_starts[occupied], dtype=np.float64)
+        return intention_prob # (intention_num,)
     
     def intention2goal(self):
-        return self.intention_sampler.idx2intent_sampling(self.intention)
+        return self.intention_sampler.idx2intent_sampling(self._to_host(self.intention))
+
+    def _to_host(self, array):
+        return array if self.xp is np else self.xp.asnumpy(array)